@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import sys, time
+import sys, time, os, socket, select, json, getopt, signal, threading
+import fcntl, hashlib, random, functools, bisect, re
 from SerialPort_linux import SerialPort, SerialPortException
 
 # baudrate used for initialization
@@ -8,6 +9,43 @@ INIT_BAUDRATE = 9600
 BOOTLOADER_BAUDRATE = 9600
 # constant for output
 SPLIT = 30
+# size of a flash page as written by writePage()
+PAGE_SIZE = 256
+# value used for page bytes not covered by the image
+PAGE_FILL = 0x00
+# value of an erased flash byte, writing it leaves the flash untouched
+ERASED = 0xFF
+# time writePage() gives the device to program a page, in seconds
+PAGE_PROGRAM_TIME = 1.0
+# time eraseAll() gives the device to erase the whole flash, in seconds
+CHIP_ERASE_TIME = 16.0
+# time eraseBlock() gives the device to erase a block, in seconds
+BLOCK_ERASE_TIME = 1.0
+# erase blocks of the user ROM: the topmost 64KB are split into 8KB
+# blocks, below them the blocks are 64KB
+SMALL_BLOCKS_START = 0xFFFF0000
+SMALL_BLOCK_SIZE = 0x2000
+LARGE_BLOCK_SIZE = 0x10000
+# lowest address of the user ROM a chip erase clears, 1MB below the top
+# of the address space covers the largest parts
+USER_ROM_START = 0xFFF00000
+
+# seconds a daemon client may take to send its job request
+REQUEST_TIMEOUT = 5.0
+# longest job request the daemon accepts, in bytes
+REQUEST_MAXSIZE = 65536
+# number of unchanged pages read back to check a manifest isn't stale
+SPOT_CHECK_PAGES = 2
+
+# timing model used by the dry-run planner, in seconds
+DEFAULT_TIMING = {
+	# turnaround of a command the device answers, USB serial adapters
+	# typically add a few milliseconds
+	"roundtrip": 0.004,
+	"program": PAGE_PROGRAM_TIME,
+	"erase": CHIP_ERASE_TIME,
+	"blockerase": BLOCK_ERASE_TIME,
+}
 
 # contains the last received checksum from a READ, WRITE or CHECKSUM command
 lastchecksum = 0
@@ -15,11 +53,70 @@ lastchecksum = 0
 flashKey = -1
 flashKeyAddr = -1
 
+# suppress the console output per record, status read and page
+quiet = False
+
+# objects notified about every protocol command, see FlashHook
+hooks = []
+# bytes sent to and received from the device so far
+bytesSent = 0
+bytesReceived = 0
+# bytes of the nested commands of each running instrumented command
+commandStack = []
+
 class FlashSequence(object):
 	def __init__(self, address, data):
 		self.address = address
 		self.data = data
 
+class FlashHook(object):
+	"""
+	base class of the objects in hooks, notified about the start and end
+	of every protocol command
+	"""
+	def commandStart(self, name):
+		pass
+
+	def commandEnd(self, name, seconds, sent, received, status):
+		"""
+		called after command name took seconds, sending and receiving the
+		given number of bytes itself, not counting the commands it calls;
+		status is "ok" or "error" if it raised
+		"""
+		pass
+
+def instrumented(func):
+	"""
+	decorator reporting the calls of a protocol command to the hooks
+	"""
+	name = func.__name__
+	@functools.wraps(func)
+	def wrapper(*args):
+		if not hooks:
+			return func(*args)
+		for hook in hooks:
+			hook.commandStart(name)
+		sent, received = bytesSent, bytesReceived
+		commandStack.append([0, 0])
+		starttime = time.time()
+		status = "error"
+		try:
+			result = func(*args)
+			status = "ok"
+			return result
+		finally:
+			seconds = time.time() - starttime
+			nestedSent, nestedReceived = commandStack.pop()
+			sent = bytesSent - sent
+			received = bytesReceived - received
+			if commandStack:
+				commandStack[-1][0] += sent
+				commandStack[-1][1] += received
+			for hook in hooks:
+				hook.commandEnd(name, seconds, sent - nestedSent,
+					received - nestedReceived, status)
+	return wrapper
+
 class MCUStatus(object):
 	NOKEY=0
 	WRONGKEY=1
@@ -41,6 +138,8 @@ def sendbyte(byte):
 	"""
 	send a byte to the TTY-device
 	"""
+	global bytesSent
+	bytesSent += 1
 	tty.write(chr(byte))
 
 def sendword(word):
@@ -63,6 +162,8 @@ def recvbyte():
 	"""
 	receive a byte from the TTY-device
 	"""
+	global bytesReceived
+	bytesReceived += 1
 	return ord(tty.read())
 
 def recvchecksum():
@@ -73,6 +174,7 @@ def recvchecksum():
 	lastchecksum = recvbyte()
 	lastchecksum |= (recvbyte() << 8)
 
+@instrumented
 def bootromread(address, size):
 	"""
 	send a READ-command to the bootROM-firmware
@@ -95,6 +197,7 @@ def bootromread(address, size):
 	recvchecksum()
 	return data
 
+@instrumented
 def bootromwrite(address, size, data):
 	"""
 	send a WRITE-command to the bootROM-firmware
@@ -115,6 +218,7 @@ def bootromwrite(address, size, data):
 	# get checksum
 	recvchecksum()
 
+@instrumented
 def bootromcall(address):
 	"""
 	send a CALL-command to the bootROM-firmware
@@ -132,6 +236,7 @@ def bootromcall(address):
 	#return recvbyte()
 
 # TODO: test this function!
+@instrumented
 def bootromchecksum():
 	"""
 	send a CHECKSUM-command to the bootROM-firmware
@@ -146,6 +251,7 @@ def bootromchecksum():
 	# get checksum
 	recvchecksum()
 
+@instrumented
 def bootrombaudrate(baudrate):
 	"""
 	send a BAUDRAME-command to the bootROM-firmware
@@ -160,6 +266,7 @@ def bootrombaudrate(baudrate):
 	# send desired baudrate
 	senddword(baudrate)
 
+@instrumented
 def pkernchiperase():
 	"""
 	send a CHIPERASE-command to the pkernel-firmware
@@ -171,6 +278,7 @@ def pkernchiperase():
 	if (recvbyte() != 0x23):
 		raise Exception
 
+@instrumented
 def pkernerase(address, size):
 	"""
 	send a ERASE-command to the pkernel-firmware
@@ -183,6 +291,7 @@ def pkernerase(address, size):
 	if (recvbyte() != 0x18):
 		raise Exception
 
+@instrumented
 def pkernwrite(address, size, data):
 	"""
 	send a WRITE-command to the pkernel-firmware
@@ -202,9 +311,9 @@ def pkernwrite(address, size, data):
 	if (recvbyte() != 0x28):
 		raise Exception
 
-def readmhxfile(filename): # desired mhx filename
+def readmhxfile(filename, records=True): # desired mhx filename
 	"""
-	proceeds a MHX-File
+	proceeds a MHX-File, records=False doesn't print the record addresses
 	"""
 	filep = open(filename, "r")
 	retval = [] # returns a list of FlashSequence objects
@@ -220,13 +329,14 @@ def readmhxfile(filename): # desired mhx filename
 			# just to get sure, check if byte count field is valid
 			if (len(line)-4) != (byte_count*2):
 				print sys.argv[0] + ": Warning - inavlid byte count field in " + \
-					sys.argv[1] + ":" + str(linecount) + ", skipping line!"
+					filename + ":" + str(linecount) + ", skipping line!"
 				continue
 
 			# address and checksum bytes are not needed
 			byte_count -= 5
 			address = int(line[4:12], 16)
-			print line[4:12] + "< hex  dec > " +str(address)
+			if records and not quiet:
+				print line[4:12] + "< hex  dec > " +str(address)
 			datastr = line[12:12+byte_count*2]
 			# convert data hex-byte-string to real byte data list
 			data = []
@@ -238,18 +348,21 @@ def readmhxfile(filename): # desired mhx filename
 	filep.close()
 	return retval
 
+@instrumented
 def clearStatus():
 	sendbyte(0x50);
 
+@instrumented
 def getStatusKey(sendKey):
 	sendbyte(0x70) # get status
 	status1 = recvbyte()
 	status2 = recvbyte()
-	print "status1: " + dec2hex(status1)
-	print "status2: " + dec2hex(status2)
-	print "bootloader ready: " + str(testBit(status1, 7))
-	print "erase fail: " + str(testBit(status1, 5))
-	print "programming fail: " + str(testBit(status1, 4))
+	if not quiet:
+		print "status1: " + dec2hex(status1)
+		print "status2: " + dec2hex(status2)
+		print "bootloader ready: " + str(testBit(status1, 7))
+		print "erase fail: " + str(testBit(status1, 5))
+		print "programming fail: " + str(testBit(status1, 4))
 	key1 = testBit(status2, 2)
 	key2 = testBit(status2, 3)
 
@@ -257,22 +370,27 @@ def getStatusKey(sendKey):
 
 	if key1 == 1 and key2 == 1:
 		status.setKeyStatus(MCUStatus.CORRECTKEY)
-		print "correct key"
+		if not quiet:
+			print "correct key"
 	elif key1 == 1 and key2 == 0:
 		status.setKeyStatus(MCUStatus.WRONGKEY)
-		print "wrong key"
+		if not quiet:
+			print "wrong key"
 	elif key1 == 0 and key2 == 0:
 		status.setKeyStatus(MCUStatus.NOKEY)
-		print "no key",
+		if not quiet:
+			print "no key",
 		if sendKey == 1:
 			sendFlashKey()
-			print " - sending key"
-		else:
+			if not quiet:
+				print " - sending key"
+		elif not quiet:
 			print
 	else:
 
 		status.setKeyStatus(MCUStatus.CORRECTKEY)
-		print "w00t"
+		if not quiet:
+			print "w00t"
 		#raise Exception('wrongkeybits!')
 
 	return status
@@ -300,73 +418,700 @@ def sendPageAddr(addr, cmd):
 	sendbyte((addr >> 16) & 0xFF)
 
 
+@instrumented
 def sendKey(addr, key):
-	print "Sending key: " + dec2hex(key) + " for addr: " + dec2hex(addr)
+	if not quiet:
+		print "Sending key: " + dec2hex(key) + " for addr: " + dec2hex(addr)
 	sendKeyAddr(addr)
 	sendbyte(0x07)
 	for i in range(7):
 		sendbyte((key >> i) & 0xFF)
 
-def readPage(addr):
+@instrumented
+def readPageData(addr):
+	"""
+	read back the page at addr and return it as a list of bytes
+	"""
 	sendPageAddr(addr, 0xff)
-	for i in range(0, 255):
-		#print "byte" + str(i) + ": " + dec2hex(recvbyte())
-		print dec2hex(recvbyte()),
+	data = []
+	for i in range(0, PAGE_SIZE):
+		data.append(recvbyte())
+	return data
+
+def readPage(addr):
+	for byte in readPageData(addr):
+		#print "byte" + str(i) + ": " + dec2hex(byte)
+		print dec2hex(byte),
 
+@instrumented
 def writePage(addr, data):
 	clearStatus()
 	getStatus()
 	sendPageAddr(addr, 0x41)
 	for byte in data:
 		sendbyte(byte)
-	print "Data written"
-	time.sleep(1) #wait 1s
+	if not quiet:
+		print "Data written"
+	time.sleep(PAGE_PROGRAM_TIME) #wait for the page to be programmed
 	getStatus()
 
+class MergeError(Exception):
+	"""Exception raised if images can't be merged"""
+
+def maskSequence(seq, masks):
+	"""
+	return the parts of FlashSequence seq inside the (start, end) ranges
+	of masks, end being exclusive
+	"""
+	if masks is None:
+		return [seq]
+	parts = []
+	end = seq.address + len(seq.data)
+	for maskstart, maskend in masks:
+		start = max(seq.address, maskstart)
+		stop = min(end, maskend)
+		if start < stop:
+			parts.append(FlashSequence(start,
+				seq.data[start - seq.address:stop - seq.address]))
+	return parts
+
+def mergePages(sources, overlap="error"):
+	"""
+	merge several images into one sorted list of (address, data) pages
+
+	sources is a list of (name, prgseqs, masks) tuples in flashing order,
+	masks limits the bytes taken from an image (see maskSequence()) or is
+	None to take all of them. Bytes covered by more than one image raise a
+	MergeError if overlap is "error" and are taken from the later image
+	if overlap is "last".
+	"""
+	pages = {}
+	owners = {} # page address -> index of the source of every byte
+	for index, (name, prgseqs, masks) in enumerate(sources):
+		for fullseq in prgseqs:
+			for seq in maskSequence(fullseq, masks):
+				addr = seq.address
+				data = seq.data
+				pos = 0
+				while pos < len(data):
+					offset = addr % PAGE_SIZE
+					pageAddr = addr - offset
+					count = min(PAGE_SIZE - offset, len(data) - pos)
+					if pageAddr not in pages:
+						pages[pageAddr] = [PAGE_FILL] * PAGE_SIZE
+						owners[pageAddr] = [None] * PAGE_SIZE
+					owner = owners[pageAddr]
+					if overlap == "error":
+						for i in range(offset, offset + count):
+							if owner[i] is not None and owner[i] != index:
+								raise MergeError(name + " overlaps " + \
+									sources[owner[i]][0] + " at addr " + \
+									dec2hex(pageAddr + i))
+					pages[pageAddr][offset:offset+count] = data[pos:pos+count]
+					owner[offset:offset+count] = [index] * count
+					addr += count
+					pos += count
+	return sorted(pages.items())
+
+def buildPages(prgseqs):
+	"""
+	assemble FlashSequences into a sorted list of (address, data) pages
+	"""
+	return mergePages([("", prgseqs, None)])
+
+def parseImageArg(arg):
+	"""
+	split an image argument FILE[@START-END[,START-END]...] into the
+	filename and its list of (start, end) masks, END being inclusive; an
+	@ not followed by masks is part of the filename
+	"""
+	maskre = "[0-9a-fA-F]+-[0-9a-fA-F]+"
+	match = re.match("^(.*)@(" + maskre + "(," + maskre + ")*)$", arg)
+	if match is None:
+		return arg, None
+	filename, maskstr = match.group(1, 2)
+	masks = []
+	for mask in maskstr.split(","):
+		start, end = [int(addr, 16) for addr in mask.split("-")]
+		if start > end:
+			raise MergeError("invalid mask '" + mask + "' in " + arg + \
+				", START is above END")
+		masks.append((start, end + 1))
+	return filename, masks
+
+def readImages(args, overlap, records=True):
+	"""
+	read the image arguments and merge them into one list of pages
+	"""
+	sources = []
+	for arg in args:
+		filename, masks = parseImageArg(arg)
+		sources.append((filename, readmhxfile(filename, records), masks))
+	return mergePages(sources, overlap)
+
+def writePages(pages):
+	for pageAddr, page in pages:
+		if not quiet:
+			print "Programming to addr " + dec2hex(pageAddr)
+		writePage(pageAddr, page)
+
 def writeProg(prgseqs):
-	lastPos = 255	
-	lastAddr = -256
-	pageAddr = 0
-	page = []
-
-	for i in range(0,len(prgseqs)):
-		addr = prgseqs[i].address
-		mod = addr%256
-		if mod < lastPos or (addr-lastAddr) >= 256:
-			#print "new page! old has " + str(len(page)) + " bytes"
-			if len(page) < 256:
-				for j in range(len(page), 256):
-					page.append(0)
-			newpage = []
-			if len(page) > 255:
-				for j in range(256, len(page)):
-					newpage.append(page[256])
-					del page[256]
-			if lastAddr >= 0:
-				#print page
-				#for byte in page:
-					#print dec2hex(byte),
-				print "Programming to addr " + dec2hex(pageAddr)
-				writePage(pageAddr, page)
-
-			page = newpage
-			pageAddr = addr - mod
-
-		if len(page) != mod:
-			#print "need filling"
-			for j in range(0,len(page)-mod):
-				page.append(0)
-		lastPos = mod 
-		lastAddr = addr
-
-		data = prgseqs[i].data
-
-		for j in range(0,len(data)):
-			page.append(data[j])
-
-		#print prgseqs[i].data
-		#print str(mod) + "< mod size > " + str(len(data))
+	writePages(buildPages(prgseqs))
+
+def verifyPages(pages, addrs):
+	"""
+	read back the pages at addrs and compare them with the image pages
+	"""
+	expected = dict(pages)
+	for addr in addrs:
+		if readPageData(addr) != expected[addr]:
+			raise Exception("verify failed at addr " + dec2hex(addr))
+
+def isBlank(data):
+	return data.count(ERASED) == len(data)
+
+def blockAddr(addr):
+	"""
+	return the start address of the erase block containing addr
+	"""
+	if addr >= SMALL_BLOCKS_START:
+		return addr - addr % SMALL_BLOCK_SIZE
+	return addr - addr % LARGE_BLOCK_SIZE
+
+def outsidePages(block, imageaddrs):
+	"""
+	return the addresses of the pages of block not in imageaddrs
+	"""
+	size = LARGE_BLOCK_SIZE
+	if block >= SMALL_BLOCKS_START:
+		size = SMALL_BLOCK_SIZE
+	return [addr for addr in range(block, block + size, PAGE_SIZE)
+		if addr not in imageaddrs]
+
+class PagePlan(object):
+	"""
+	the page operations programming an image performs on the device
+	"""
+	def __init__(self, pages, chiperase=False, verify=False, delta=False,
+			blankcheck=False):
+		self.chiperase = chiperase
+		self.blocks = []
+		# erases found to be unnecessary, "chip" or block addresses
+		self.eraseskipped = []
+		self.readback = verify
+		# pages of erased bytes only don't change the flash content
+		self.write = [page for page in pages if not isBlank(page[1])]
+		self.skip = [page for page in pages if isBlank(page[1])]
+		self.verify = []
+		if verify:
+			self.verify = [addr for addr, data in self.write]
+		# pages found to hold the image data already
+		self.same = []
+		# pages to compare with the device before deciding what to write
+		self.compare = []
+		if delta and not chiperase:
+			self.compare = [addr for addr, data in pages]
+		# pages to read back to find out whether the chip erase is needed,
+		# all of the user ROM as the erase clears more than the image
+		self.blankcheck = []
+		if blankcheck and chiperase:
+			self.blankcheck = range(USER_ROM_START, 1 << 32, PAGE_SIZE)
+
+	def eraseBlocks(self, blocks, writes=()):
+		"""
+		limit the plan to erasing blocks and writing the image pages
+		inside them plus the pages at the addresses writes, which have to
+		be erased on the device already; all other pages are skipped
+		"""
+		pages = sorted(self.write + self.skip)
+		writes = set(writes)
+		self.blocks = sorted(blocks)
+		self.write = [page for page in pages if not isBlank(page[1]) and \
+			(blockAddr(page[0]) in blocks or page[0] in writes)]
+		self.skip = [page for page in pages if isBlank(page[1]) or \
+			(blockAddr(page[0]) not in blocks and page[0] not in writes)]
+		# blocks with differing pages that are written without erasing
+		self.eraseskipped = [dec2hex(block) for block in
+			sorted(set([blockAddr(addr) for addr in writes]) - set(blocks))]
+		self.compare = []
+		self.verify = []
+		if self.readback:
+			self.verify = [addr for addr, data in self.write]
+
+def reportDelta(source, plan, erase, writes):
+	"""
+	print how many blocks a delta plan erases or writes without erasing
+	"""
+	blocks = set([blockAddr(addr) for addr in plan.compare])
+	changed = erase | set([blockAddr(addr) for addr in writes])
+	print source + ": " + str(len(changed)) + " of " + str(len(blocks)) + \
+		" blocks differ, " + str(len(erase)) + " of them need an erase"
+
+def reportSkipped(plan):
+	if plan.eraseskipped:
+		print "Blank check: erase skipped for " + ", ".join(plan.eraseskipped)
+
+def planDelta(plan):
+	"""
+	read back the pages to compare of plan and reduce it to the blocks
+	holding pages that differ from the image; differing pages that are
+	erased on the device are written without erasing their block
+	"""
+	if not plan.compare:
+		return
+	expected = dict(plan.write + plan.skip)
+	erase = set()
+	writes = []
+	same = []
+	for addr in plan.compare:
+		if blockAddr(addr) in erase:
+			continue
+		readback = readPageData(addr)
+		if readback == expected[addr]:
+			same.append(addr)
+		elif isBlank(readback):
+			writes.append(addr)
+		else:
+			erase.add(blockAddr(addr))
+	reportDelta("Delta", plan, erase, writes)
+	plan.eraseBlocks(erase, writes)
+	plan.same = [addr for addr in same if blockAddr(addr) not in erase]
+	reportSkipped(plan)
+
+def pageHash(data):
+	return hashlib.sha1("".join([chr(byte) for byte in data])).hexdigest()
+
+def manifestKey(board, version):
+	"""
+	return the manifest key of a device, board being a board id or port
+	"""
+	return board + "/" + version.strip()
+
+def lockFile(filename):
+	"""
+	take an exclusive lock belonging to filename, shared with forked
+	daemon workers, and return it for unlockFile()
+	"""
+	lockp = open(filename + ".lock", "a")
+	fcntl.flock(lockp, fcntl.LOCK_EX)
+	return lockp
+
+def unlockFile(lockp):
+	fcntl.flock(lockp, fcntl.LOCK_UN)
+	lockp.close()
+
+def loadJSON(filename):
+	"""
+	return the JSON content of filename or {} if it doesn't exist
+	"""
+	if not os.path.exists(filename):
+		return {}
+	filep = open(filename, "r")
+	try:
+		return json.load(filep)
+	finally:
+		filep.close()
+
+def writeFileAtomic(filename, text):
+	"""
+	replace filename with text, readers never see a partial file
+	"""
+	tmpname = filename + ".tmp"
+	filep = open(tmpname, "w")
+	filep.write(text)
+	filep.close()
+	os.rename(tmpname, filename)
+
+class FlashManifest(object):
+	"""
+	local store of the page hashes last flashed to each device
+
+	The store is a JSON file mapping manifestKey()s to a dictionary of
+	hex page addresses and page hashes. Updates lock the file, so forked
+	daemon workers can share it.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+
+	def lookup(self, key):
+		"""
+		return a dictionary of page address -> hash for key or None
+		"""
+		pages = loadJSON(self.filename).get(key)
+		if pages is None:
+			return None
+		return dict([(int(addr, 16), pagehash)
+			for addr, pagehash in pages.items()])
+
+	def update(self, key, plan):
+		"""
+		record the device content after plan ran on it, only a verified
+		flash is recorded, otherwise the device is forgotten
+		"""
+		lockp = lockFile(self.filename)
+		try:
+			devices = loadJSON(self.filename)
+			if plan is None or not plan.readback:
+				devices.pop(key, None)
+			else:
+				pages = devices.get(key, {})
+				if plan.chiperase:
+					pages = {}
+				for addr in pages.keys():
+					if blockAddr(int(addr, 16)) in plan.blocks:
+						del pages[addr]
+				same = set(plan.same)
+				for addr, data in plan.write + plan.skip:
+					# written pages are verified, skipped ones are known if
+					# they were erased or found to be the same
+					if addr in plan.verify or addr in same or plan.chiperase \
+							or blockAddr(addr) in plan.blocks:
+						pages[dec2hex(addr)] = pageHash(data)
+				devices[key] = pages
+			writeFileAtomic(self.filename,
+				json.dumps(devices, indent=1, sort_keys=True))
+		finally:
+			unlockFile(lockp)
+
+	def forget(self, key):
+		self.update(key, None)
+
+class CommandStats(FlashHook):
+	"""
+	hook counting the calls, errors and bytes of every command and
+	keeping a histogram of its latencies
+
+	save() adds the counts to jsonfile, so they accumulate over runs and
+	forked daemon workers, and writes these totals in the Prometheus text
+	format to promfile if given. Without a jsonfile the totals are kept
+	in promfile + ".state". Bytes of a command don't include those
+	of the commands it calls, so their sum is the traffic with the device.
+	"""
+	# upper bounds of the latency histogram buckets, in seconds
+	BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0]
+	COUNTERS = ["count", "errors", "seconds", "sent", "received"]
+
+	def __init__(self, jsonfile=None, promfile=None):
+		self.jsonfile = jsonfile
+		if jsonfile is None:
+			self.jsonfile = promfile + ".state"
+		self.promfile = promfile
+		self.commands = {}
+
+	def newEntry(self):
+		entry = dict([(counter, 0) for counter in self.COUNTERS])
+		entry["buckets"] = [0] * (len(self.BUCKETS) + 1)
+		return entry
+
+	def commandEnd(self, name, seconds, sent, received, status):
+		entry = self.commands.get(name)
+		if entry is None:
+			entry = self.commands[name] = self.newEntry()
+		entry["count"] += 1
+		if status != "ok":
+			entry["errors"] += 1
+		entry["seconds"] += seconds
+		entry["sent"] += sent
+		entry["received"] += received
+		entry["buckets"][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+	def save(self):
+		lockp = lockFile(self.jsonfile)
+		try:
+			commands = loadJSON(self.jsonfile).get("commands", {})
+			for name, entry in self.commands.items():
+				total = commands.setdefault(name, self.newEntry())
+				for counter in self.COUNTERS:
+					total[counter] += entry[counter]
+				total["buckets"] = [a + b for a, b in
+					zip(total["buckets"], entry["buckets"])]
+			writeFileAtomic(self.jsonfile, json.dumps({
+				"buckets": self.BUCKETS, "commands": commands},
+				indent=1, sort_keys=True))
+			if self.promfile is not None:
+				writeFileAtomic(self.promfile, self.prometheus(commands))
+		finally:
+			unlockFile(lockp)
+
+	def prometheus(self, commands):
+		"""
+		return commands in the Prometheus text exposition format
+		"""
+		lines = [
+			"# HELP r32c_command_duration_seconds Duration of bootROM, pkernel and page commands.",
+			"# TYPE r32c_command_duration_seconds histogram"]
+		for name in sorted(commands):
+			entry = commands[name]
+			count = 0
+			for bound, hits in zip(self.BUCKETS, entry["buckets"]):
+				count += hits
+				lines.append('r32c_command_duration_seconds_bucket{command="%s",le="%g"} %d'
+					% (name, bound, count))
+			lines.append('r32c_command_duration_seconds_bucket{command="%s",le="+Inf"} %d'
+				% (name, entry["count"]))
+			lines.append('r32c_command_duration_seconds_sum{command="%s"} %f'
+				% (name, entry["seconds"]))
+			lines.append('r32c_command_duration_seconds_count{command="%s"} %d'
+				% (name, entry["count"]))
+		for metric, counter, text in [
+				("r32c_command_errors_total", "errors", "Commands that raised an error."),
+				("r32c_command_sent_bytes_total", "sent", "Bytes sent to the device by the command itself, not by nested commands."),
+				("r32c_command_received_bytes_total", "received", "Bytes received from the device by the command itself, not by nested commands.")]:
+			lines.append("# HELP " + metric + " " + text)
+			lines.append("# TYPE " + metric + " counter")
+			for name in sorted(commands):
+				lines.append('%s{command="%s"} %d' % (metric, name, commands[name][counter]))
+		return "\n".join(lines) + "\n"
+
+def planManifest(plan, known):
+	"""
+	reduce plan to the blocks holding pages whose hashes differ from the
+	known ones, without reading back the device except for a few
+	unchanged pages. Returns False, leaving plan alone, if these show the
+	manifest to be stale.
+	"""
+	blank = [ERASED] * PAGE_SIZE
+	blankhash = pageHash(blank)
+	erase = set()
+	writes = []
+	for addr, data in plan.write + plan.skip:
+		pagehash = known.get(addr)
+		if pagehash == pageHash(data):
+			continue
+		if pagehash == blankhash:
+			writes.append(addr)
+		else:
+			erase.add(blockAddr(addr))
+	# expected readback of the pages outside the blocks to erase
+	unchanged = []
+	for addr, data in plan.write + plan.skip:
+		if addr in writes:
+			unchanged.append((addr, blank))
+		elif blockAddr(addr) not in erase:
+			unchanged.append((addr, data))
+	for addr, data in random.sample(unchanged,
+			min(SPOT_CHECK_PAGES, len(unchanged))):
+		if readPageData(addr) != data:
+			print "Manifest is stale at addr " + dec2hex(addr) + \
+				", comparing all pages"
+			return False
+	reportDelta("Manifest", plan, erase, writes)
+	plan.eraseBlocks(erase, writes)
+	reportSkipped(plan)
+	return True
+
+def pageReadTime(baudrate, timing):
+	"""
+	return the time reading back a page takes, page address and data
+	"""
+	return (5 + PAGE_SIZE) * 10.0 / baudrate + timing["roundtrip"]
+
+def blankCheckPays(plan, timing, baudrate=BOOTLOADER_BAUDRATE):
+	"""
+	tell whether reading back the pages to blank check is faster than
+	the chip erase it may save
+	"""
+	return len(plan.blankcheck) * pageReadTime(baudrate, timing) < \
+		timing["erase"]
+
+def planBlankCheck(plan, timing):
+	"""
+	read back the user ROM of a chip erase plan and drop the erase if
+	it is erased already, stopping at the first page holding data
+	"""
+	if not plan.blankcheck:
+		return
+	if not blankCheckPays(plan, timing):
+		print "No blank check, reading the pages takes longer than " + \
+			"the chip erase"
+		return
+	for addr in plan.blankcheck:
+		if not isBlank(readPageData(addr)):
+			print "Blank check: addr " + dec2hex(addr) + \
+				" isn't erased, erasing chip"
+			return
+	plan.chiperase = False
+	plan.blankcheck = []
+	plan.eraseskipped = ["chip"]
+	# the erased pages of the image are on the device already
+	plan.same = [addr for addr, data in plan.skip]
+	reportSkipped(plan)
+
+def saveBlock(block, imageaddrs):
+	"""
+	read back the pages of block outside the image, which erasing the
+	block would destroy, and return those holding data as pages
+	"""
+	saved = []
+	for addr in outsidePages(block, imageaddrs):
+		data = readPageData(addr)
+		if not isBlank(data):
+			saved.append((addr, data))
+	return saved
+
+def runPlan(plan):
+	"""
+	execute a PagePlan on the device, pages outside the image in the
+	blocks it erases are read back before and rewritten after the erase
+	"""
+	if plan.chiperase:
+		eraseAll()
+	imageaddrs = set([addr for addr, data in plan.write + plan.skip])
+	restored = []
+	for addr in plan.blocks:
+		saved = saveBlock(addr, imageaddrs)
+		eraseBlock(addr)
+		if saved:
+			print "Restoring " + str(len(saved)) + \
+				" pages outside the image in block " + dec2hex(addr)
+			writePages(saved)
+			restored += saved
+	writePages(plan.write)
+	time.sleep(0.5) #wait 500ms
+	getStatus()
+	verifyaddrs = plan.verify
+	if plan.readback:
+		verifyaddrs = verifyaddrs + [addr for addr, data in restored]
+	verifyPages(plan.write + restored, verifyaddrs)
+
+def flashPlan(plan, manifest=None, key=None, timing=DEFAULT_TIMING):
+	"""
+	drop an unneeded chip erase of plan and narrow a delta plan down
+	using the manifest, or by reading back the device if there is no
+	valid manifest entry for key, run it and record the new device
+	content in the manifest
+	"""
+	planBlankCheck(plan, timing)
+	known = None
+	if manifest is not None and plan.compare:
+		known = manifest.lookup(key)
+	if known is None or not planManifest(plan, known):
+		planDelta(plan)
+	try:
+		runPlan(plan)
+	except:
+		if manifest is not None:
+			manifest.forget(key)
+		raise
+	if manifest is not None:
+		manifest.update(key, plan)
+
+class ImageReader(threading.Thread):
+	"""
+	background thread reading and merging the images into a PagePlan,
+	so the parsing overlaps opening the port and the RESET wait; the
+	record addresses aren't printed, they would bury the RESET prompt
+	"""
+	def __init__(self, args, overlap, chiperase, verify, delta, blankcheck):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.args = args
+		self.overlap = overlap
+		self.chiperase = chiperase
+		self.verify = verify
+		self.delta = delta
+		self.blankcheck = blankcheck
+		self.plan = None
+		self.error = None
+
+	def run(self):
+		try:
+			self.plan = PagePlan(readImages(self.args, self.overlap, False),
+				self.chiperase, self.verify, self.delta, self.blankcheck)
+		except Exception as error:
+			self.error = error
+
+	def getPlan(self):
+		"""
+		wait for the images to be read and return the PagePlan, errors
+		of the background thread are raised here
+		"""
+		self.join()
+		if self.error is not None:
+			raise self.error
+		return self.plan
+
+def estimatePlan(plan, baudrate, timing):
+	"""
+	predict how long running plan takes, returns a list of
+	(step, count, seconds) tuples
+	"""
+	bytetime = 10.0 / baudrate # 8N1: start bit, 8 data bits, stop bit
+	roundtrip = timing["roundtrip"]
+	steps = []
+	# 16 sync bytes 21ms apart, baudrate, version and key status
+	steps.append(("sync", 1, 16 * 0.021 + 32 * bytetime + 3 * roundtrip))
+	readtime = pageReadTime(baudrate, timing)
+	steps.append(("compare", len(plan.compare), len(plan.compare) * readtime))
+	blankchecks = 0
+	if plan.blankcheck and blankCheckPays(plan, timing, baudrate):
+		blankchecks = len(plan.blankcheck)
+	steps.append(("blank check", blankchecks, blankchecks * readtime))
+	if plan.chiperase:
+		steps.append(("chip erase", 1,
+			timing["erase"] + 6 * bytetime + roundtrip))
+	# clear status, block address, confirm, status
+	blocktime = timing["blockerase"] + 10 * bytetime + roundtrip
+	blocks = plan.blocks
+	if plan.compare:
+		# at most every block holding a compared page
+		blocks = set([blockAddr(addr) for addr in plan.compare])
+	# pages outside the image in erased blocks are read back first
+	imageaddrs = set([addr for addr, data in plan.write + plan.skip])
+	saves = sum([len(outsidePages(block, imageaddrs)) for block in blocks])
+	steps.append(("save", saves, saves * readtime))
+	steps.append(("block erase", len(blocks), len(blocks) * blocktime))
+	# clear status, status, page address, data, status
+	pagetime = timing["program"] + (1 + 3 + 5 + PAGE_SIZE + 3) * bytetime + \
+		2 * roundtrip
+	steps.append(("write", len(plan.write), len(plan.write) * pagetime))
+	steps.append(("skip", len(plan.skip), 0.0))
+	steps.append(("status", 1, 0.5 + 3 * bytetime + roundtrip))
+	steps.append(("verify", len(plan.verify), len(plan.verify) * readtime))
+	return steps
+
+def pageRanges(addrs):
+	"""
+	return a string of the address ranges covered by the pages at addrs
+	"""
+	ranges = []
+	for addr in sorted(addrs):
+		if ranges and ranges[-1][1] == addr:
+			ranges[-1][1] = addr + PAGE_SIZE
+		else:
+			ranges.append([addr, addr + PAGE_SIZE])
+	return ", ".join([dec2hex(start) + "-" + dec2hex(end - 1)
+		for start, end in ranges])
 
+def printPlan(plan, baudrate, timing):
+	"""
+	print the pages touched by plan and the estimated time per step
+	"""
+	print "Dry run at " + str(baudrate) + " baud, nothing is sent to the device"
+	if plan.compare:
+		print "compare: " + pageRanges(plan.compare)
+		print "(write and verify are upper bounds, the blocks to erase depend on the device)"
+		print "(an erased block loses its data outside the image, save reads it back"
+		print " first and pages holding data are rewritten, which adds to write and verify)"
+	if plan.chiperase:
+		print "erase:  whole chip"
+	if plan.blankcheck and blankCheckPays(plan, timing, baudrate):
+		print "blank check: " + pageRanges(plan.blankcheck)
+		print "(the chip erase is skipped if the whole user ROM is erased)"
+	elif plan.blankcheck:
+		print "(no blank check, reading the pages takes longer than the chip erase)"
+	if plan.blocks:
+		print "erase:  blocks " + ", ".join([dec2hex(addr) for addr in plan.blocks])
+	print "write:  " + pageRanges([addr for addr, data in plan.write])
+	print "skip:   " + pageRanges([addr for addr, data in plan.skip])
+	print "verify: " + pageRanges(plan.verify)
+	total = 0.0
+	for step, count, seconds in estimatePlan(plan, baudrate, timing):
+		print "  %-12s %6d %10.2fs" % (step, count, seconds)
+		total += seconds
+	print "  %-12s %6s %10.2fs" % ("total", "", total)
+
+@instrumented
 def sendFlashKey():
 	correct = 0
 	global flashKey
@@ -406,21 +1151,402 @@ def sendFlashKey():
 	return correct
 
 
+@instrumented
 def eraseAll():
 	clearStatus()
 	sendbyte(0xa7)
 	sendbyte(0xd0)
 	print "issued eraseAll"
 	#loop with greater timeout and status checking
-	time.sleep(16) # 16 sec waiting, too lazy to write loop ^^
+	time.sleep(CHIP_ERASE_TIME) # 16 sec waiting, too lazy to write loop ^^
+	getStatus()
+
+
+@instrumented
+def eraseBlock(addr):
+	clearStatus()
+	sendPageAddr(addr, 0x20)
+	sendbyte(0xd0)
+	if not quiet:
+		print "issued erase for block " + dec2hex(addr)
+	time.sleep(BLOCK_ERASE_TIME)
 	getStatus()
 
+@instrumented
+def syncDevice():
+	"""
+	synchronise with the bootloader after a RESET and return the chip
+	version, its non-printable bytes escaped so it fits JSON results and
+	manifest keys
+	"""
+	for i in range(16):
+		sendbyte(0x00)
+		time.sleep(0.021) #wait 21ms
+
+	sendbyte(0xb0) # set 9600 baud
+	baudstatus = recvbyte()
+	if not quiet:
+		print "status byte after baudset: ", baudstatus
+
+	sendbyte(0xfb) # get version
+
+	version = ""
+	for i in range(8):
+		version = version + chr(recvbyte())
+	return version.encode("string_escape")
+
+def errorText(error):
+	"""
+	return a readable message for an exception raised while flashing
+	"""
+	if isinstance(error, SerialPortException):
+		# SerialPortException stores its message as a tuple of characters
+		return "".join(error.args)
+	if str(error):
+		return str(error)
+	return error.__class__.__name__
+
+def imageErrorText(error):
+	"""
+	return a readable message for an exception raised reading images
+	"""
+	if isinstance(error, IOError):
+		return "couldn't open file " + error.filename + "!"
+	return errorText(error)
+
+class FlashImage(object):
+	"""
+	firmware image parsed and assembled into pages ahead of time
+	"""
+	def __init__(self, name, args, overlap="error"):
+		self.name = name
+		self.args = args
+		self.pages = readImages(args, overlap)
+
+	def plan(self, options):
+		return PagePlan(self.pages, options.get("erase", False),
+			options.get("verify", False), options.get("delta", False),
+			options.get("blankcheck", False))
+
+class FlashJob(object):
+	"""
+	request to program an image to the board on a serial port
+	"""
+	def __init__(self, jobid, image, port, options, conn):
+		self.jobid = jobid
+		self.image = image
+		self.port = port
+		self.options = options
+		self.conn = conn
+
+def resetDevice(options):
+	"""
+	pulse DTR to reset the board, if the job asks for it
+	"""
+	if options.get("reset") == "dtr":
+		tty.dtr_on()
+		time.sleep(0.1)
+		tty.dtr_off()
+		time.sleep(0.1)
+
+def runJob(job, port, manifest=None):
+	"""
+	program job.image over the already opened SerialPort port and
+	return a result dictionary, recording the flashed pages in the
+	FlashManifest manifest if given
+	"""
+	global tty
+	tty = port
+	result = {
+		"id": job.jobid,
+		"image": job.image.name,
+		"port": job.port,
+		"pages": len(job.image.pages),
+	}
+	starttime = time.time()
+	try:
+		resetDevice(job.options)
+		tty.flush()
+		result["chipversion"] = syncDevice()
+		clearStatus()
+		if sendFlashKey() == 0:
+			raise Exception("no valid key found")
+		clearStatus()
+		plan = job.image.plan(job.options)
+		key = manifestKey(job.options.get("board", job.port),
+			result["chipversion"])
+		flashPlan(plan, manifest, key)
+		result["written"] = len(plan.write)
+		result["erased"] = len(plan.blocks)
+		result["eraseskipped"] = plan.eraseskipped
+		result["status"] = "ok"
+	except Exception as error:
+		result["status"] = "error"
+		result["error"] = errorText(error)
+	result["duration"] = round(time.time() - starttime, 3)
+	return result
+
+def sendResult(conn, result):
+	"""
+	send a result dictionary as one JSON line and close the connection
+	"""
+	try:
+		conn.setblocking(1)
+		conn.sendall(json.dumps(result) + "\n")
+	except socket.error:
+		pass
+	conn.close()
+
+class FlashDaemon(object):
+	"""
+	server mode: keep serial ports open and images loaded, accept flash
+	jobs on a Unix socket and run them in forked workers
+
+	A client sends one JSON object per connection and terminated by a
+	newline, e.g. {"image": "app", "port": "/dev/ttyUSB0",
+	"options": {"reset": "dtr", "erase": false, "blankcheck": false,
+	"verify": true, "delta": false, "board": "42"}}, and receives one JSON
+	object with the result once the job has finished. Jobs on the same
+	port are run one after another, at most 'workers' jobs run at once.
+	"""
+	def __init__(self, sockpath, images, workers, manifest=None, stats=None):
+		self.sockpath = sockpath
+		self.images = images # image name -> FlashImage
+		self.workers = workers
+		self.manifest = manifest
+		self.stats = stats # CommandStats, filled and saved by each worker
+		self.ports = {} # device -> SerialPort
+		self.queues = {} # device -> list of waiting FlashJobs
+		self.running = {} # worker pid -> device
+		self.pending = {} # connection -> [received data, deadline]
+		self.jobcount = 0
+
+	def openPort(self, device):
+		if device not in self.ports:
+			self.ports[device] = SerialPort(device, 100, INIT_BAUDRATE)
+			self.queues[device] = []
+		return self.ports[device]
+
+	def readRequest(self, conn):
+		"""
+		receive the data waiting on the pending connection conn and
+		queue the job once its request line is complete
+		"""
+		try:
+			data = conn.recv(4096)
+		except socket.error:
+			data = ""
+		if not data:
+			del self.pending[conn]
+			conn.close()
+			return
+		self.pending[conn][0] += data
+		received = self.pending[conn][0]
+		if "\n" in received:
+			del self.pending[conn]
+			self.acceptJob(conn, received.split("\n", 1)[0])
+		elif len(received) > REQUEST_MAXSIZE:
+			del self.pending[conn]
+			sendResult(conn, {"status": "error", "error": "invalid request"})
+
+	def expireRequests(self):
+		now = time.time()
+		for conn, (received, deadline) in self.pending.items():
+			if now > deadline:
+				del self.pending[conn]
+				sendResult(conn, {"status": "error",
+					"error": "timeout reading request"})
+
+	def acceptJob(self, conn, line):
+		"""
+		parse the job request line received on conn and queue the job
+		"""
+		try:
+			request = json.loads(line)
+		except ValueError:
+			request = None
+		if not isinstance(request, dict) or \
+				not isinstance(request.get("image"), basestring) or \
+				not isinstance(request.get("port"), basestring) or \
+				not isinstance(request.get("options", {}), (dict, type(None))):
+			sendResult(conn, {"status": "error", "error": "invalid request"})
+			return
+
+		self.jobcount += 1
+		jobid = request.get("id", self.jobcount)
+		image = self.images.get(request.get("image"))
+		if image is None:
+			sendResult(conn, {"id": jobid, "status": "error",
+				"error": "unknown image " + str(request.get("image"))})
+			return
+		options = request.get("options") or {}
+		# as with -e --delta, a chip erase leaves nothing to compare
+		if options.get("erase") and options.get("delta"):
+			sendResult(conn, {"id": jobid, "status": "error",
+				"error": "erase and delta can't be combined"})
+			return
+		device = request.get("port")
+		try:
+			self.openPort(device)
+		except Exception:
+			# SerialPortException, or termios errors for a non-tty
+			sendResult(conn, {"id": jobid, "status": "error",
+				"error": "couldn't open port " + str(device)})
+			return
+		self.queues[device].append(FlashJob(jobid, image, device, options, conn))
+
+	def startJobs(self):
+		"""
+		fork a worker for every idle port with waiting jobs, as long as
+		the worker limit allows it
+		"""
+		busy = self.running.values()
+		for device in self.queues:
+			if len(self.running) >= self.workers:
+				break
+			if device in busy or not self.queues[device]:
+				continue
+			job = self.queues[device].pop(0)
+			pid = os.fork()
+			if pid == 0:
+				try:
+					if self.stats is not None:
+						hooks.append(self.stats)
+					result = runJob(job, self.ports[device], self.manifest)
+					sendResult(job.conn, result)
+					if self.stats is not None:
+						self.stats.save()
+				finally:
+					os._exit(0)
+			job.conn.close()
+			self.running[pid] = device
+
+	def reapJobs(self):
+		while self.running:
+			pid, status = os.waitpid(-1, os.WNOHANG)
+			if pid == 0:
+				break
+			del self.running[pid]
+
+	def serve(self):
+		if os.path.exists(self.sockpath):
+			os.unlink(self.sockpath)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.sockpath)
+		server.listen(16)
+		print "Waiting for jobs on " + self.sockpath
+		try:
+			while True:
+				readable = select.select([server] + self.pending.keys(),
+					[], [], 0.1)[0]
+				for conn in readable:
+					if conn is server:
+						conn = server.accept()[0]
+						conn.setblocking(0)
+						self.pending[conn] = ["", time.time() + REQUEST_TIMEOUT]
+					else:
+						self.readRequest(conn)
+				self.expireRequests()
+				self.reapJobs()
+				self.startJobs()
+		finally:
+			server.close()
+			os.unlink(self.sockpath)
+
+def daemonMain(argv):
+	"""
+	parse the command line of the server mode and run the daemon
+	"""
+	if len(argv) < 3:
+		usage(argv[0])
+		return 1
+	sockpath = argv[2]
+	try:
+		opts, args = getopt.gnu_getopt(argv[3:], "d:j:q",
+			["overlap=", "manifest=", "stats-json=", "stats-prom="])
+	except getopt.GetoptError:
+		usage(argv[0])
+		return 1
+	if not args:
+		usage(argv[0])
+		return 1
+
+	devices = []
+	workers = 0
+	overlap = "error"
+	manifest = None
+	statsjson = None
+	statsprom = None
+	global quiet
+	for opt, value in opts:
+		if opt == "-d":
+			devices.append(value)
+		elif opt == "-q":
+			quiet = True
+		elif opt == "--stats-json":
+			statsjson = value
+		elif opt == "--stats-prom":
+			statsprom = value
+		elif opt == "-j":
+			try:
+				workers = int(value)
+			except ValueError:
+				workers = 0
+			if workers <= 0:
+				usage(argv[0])
+				return 1
+		elif opt == "--overlap":
+			overlap = value
+		elif opt == "--manifest":
+			manifest = FlashManifest(value)
+	if overlap not in ("error", "last"):
+		usage(argv[0])
+		return 1
+
+	# preload and assemble all images, NAME=FILE[+FILE...] or FILE (named
+	# by basename)
+	images = {}
+	for arg in args:
+		if "=" in arg:
+			name, files = arg.split("=", 1)
+		else:
+			files = arg
+			name = os.path.splitext(os.path.basename(arg))[0]
+		try:
+			images[name] = FlashImage(name, files.split("+"), overlap)
+		except (IOError, MergeError, ValueError) as error:
+			print argv[0] + ": Error - " + name + ": " + imageErrorText(error)
+			return 1
+
+	stats = None
+	if statsjson or statsprom:
+		stats = CommandStats(statsjson, statsprom)
+	daemon = FlashDaemon(sockpath, images, workers or max(len(devices), 1),
+		manifest, stats)
+	for device in devices:
+		try:
+			daemon.openPort(device)
+		except SerialPortException as error:
+			print errorText(error) + " Device: " + device + "!"
+			return 1
+
+	# leave through serve()'s cleanup when stopped by the init system
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		daemon.serve()
+	except KeyboardInterrupt:
+		pass
+	return 0
 
 def usage(execf):
 	"""
 	print usage of frprog
 	"""
-	print "Usage: " + execf + " <target mhx-file> [-d DEVICE]"
+	print "Usage: " + execf + " <target mhx-file>... [-d DEVICE] [-e [--blank-check]|--delta] [--verify] [--overlap=error|last] [--manifest FILE [--board ID]] [-q] [--stats-json FILE] [--stats-prom FILE]"
+	print "       " + execf + " <target mhx-file>... --dry-run [-e [--blank-check]|--delta] [--verify] [-b BAUD] [-t KEY=SECONDS]..."
+	print "       " + execf + " --daemon SOCKET [-d DEVICE]... [-j WORKERS] [--manifest FILE] [-q] [--stats-json FILE] [--stats-prom FILE] [NAME=]<mhx-file>[+<mhx-file>]..."
+	print "An mhx-file may be followed by @START-END[,START-END]... (hex, inclusive)"
+	print "to only take the bytes inside these address ranges from it."
 
 def main(argv=None):
 	"""
@@ -434,30 +1560,120 @@ def main(argv=None):
 		print "Version: %VERSION%"
 		return 0
 
-	#TODO: ...
-	#if len(argv) != 2 and len(argv) != 4:
-	if len(argv) != 2:
+	if len(argv) >= 2 and argv[1] == "--daemon":
+		return daemonMain(argv)
+
+	try:
+		opts, args = getopt.gnu_getopt(argv[1:], "d:eb:t:q",
+			["dry-run", "verify", "delta", "blank-check", "overlap=",
+			"manifest=", "board=",
+			"stats-json=", "stats-prom="])
+	except getopt.GetoptError:
+		usage(argv[0])
+		return 1
+	if not args:
 		usage(argv[0])
 		return 1
 
 	# standard serial device to communicate with
 	device = "/dev/ttyUSB0"
+	chiperase = False
+	verify = False
+	delta = False
+	blankcheck = False
+	manifest = None
+	board = None
+	statsjson = None
+	statsprom = None
+	global quiet
+	dryrun = False
+	overlap = "error"
+	baudrate = None
+	timing = dict(DEFAULT_TIMING)
+	timed = False
+	for opt, value in opts:
+		if opt == "-d":
+			# overrule standard device
+			device = value
+		elif opt == "-e":
+			chiperase = True
+		elif opt == "--verify":
+			verify = True
+		elif opt == "--delta":
+			delta = True
+		elif opt == "--blank-check":
+			blankcheck = True
+		elif opt == "--manifest":
+			manifest = FlashManifest(value)
+		elif opt == "--board":
+			board = value
+		elif opt == "-q":
+			quiet = True
+		elif opt == "--stats-json":
+			statsjson = value
+		elif opt == "--stats-prom":
+			statsprom = value
+		elif opt == "--dry-run":
+			dryrun = True
+		elif opt == "--overlap":
+			overlap = value
+		elif opt == "-b":
+			try:
+				baudrate = int(value)
+			except ValueError:
+				baudrate = 0
+			if baudrate <= 0:
+				usage(argv[0])
+				return 1
+		elif opt == "-t":
+			key, sep, seconds = value.partition("=")
+			try:
+				seconds = float(seconds)
+			except ValueError:
+				seconds = -1
+			if key not in timing or seconds < 0:
+				usage(argv[0])
+				return 1
+			timing[key] = seconds
+			timed = True
+
+	# -b and -t only set the baudrate and timing the dry run estimates
+	# for, the real run keeps the bootloader baudrate and its fixed waits
+	if (baudrate is not None or timed) and not dryrun:
+		usage(argv[0])
+		return 1
+	if baudrate is None:
+		baudrate = BOOTLOADER_BAUDRATE
 
-	# overrule standard device if provided with -d
-	if len(argv) == 4:
-		if argv[2] == "-d":
-			device = argv[3]
-		else:
-			usage(argv[0])
+	if overlap not in ("error", "last") or (chiperase and delta) or \
+			(blankcheck and not chiperase):
+		usage(argv[0])
+		return 1
+
+	if dryrun:
+		try:
+			plan = PagePlan(readImages(args, overlap), chiperase, verify, delta,
+				blankcheck)
+		except (IOError, MergeError, ValueError) as error:
+			print argv[0] + ": Error - " + imageErrorText(error)
 			return 1
+		printPlan(plan, baudrate, timing)
+		return 0
 
-	# read in data from mhx-files before starting
+	# fail on missing files before the port is set up and the board is
+	# reset, the images are only parsed in the background
 	try:
-		prgseqs = readmhxfile(argv[1])
-	except IOError as error:
-		print argv[0] + ": Error - couldn't open file " + error.filename + "!"
+		for arg in args:
+			open(parseImageArg(arg)[0], "r").close()
+	except (IOError, MergeError) as error:
+		print argv[0] + ": Error - " + imageErrorText(error)
 		return 1
 
+	# read in data from mhx-files and merge them in the background while
+	# the port is set up and the board is reset
+	reader = ImageReader(args, overlap, chiperase, verify, delta, blankcheck)
+	reader.start()
+
 	print "Initializing serial port..."
 	global tty
 	try:
@@ -470,41 +1686,41 @@ def main(argv=None):
 	raw_input("Please push the RESET button on your board and press any ENTER to continue...")
 	#TODO: wait for user input
 
-	for i in range(16):
-		sendbyte(0x00)
-		time.sleep(0.021) #wait 21ms
-	
-	sendbyte(0xb0) # set 9600 baud
-	print "status byte after baudset: ", recvbyte()
+	try:
+		plan = reader.getPlan()
+	except (IOError, MergeError, ValueError) as error:
+		print argv[0] + ": Error - " + imageErrorText(error)
+		return 1
 
-	sendbyte(0xfb) # get version
+	stats = None
+	if statsjson or statsprom:
+		stats = CommandStats(statsjson, statsprom)
+		hooks.append(stats)
 
-	version = ""
-	for i in range(8):
-		version = version + chr(recvbyte())
+	try:
+		version = syncDevice()
+		print "chipversion: ", version
 
-	print "chipversion: ", version
+		clearStatus()
 
-	clearStatus()
+		if sendFlashKey() == 0:
+			print "No Valid Key found! Powercycle the board or provide correct key!"
+			return 1
 
-	if sendFlashKey() == 0:
-		print "No Valid Key found! Powercycle the board or provide correct key!"
-		return 1
+		#readPage(0xffff0000)
 
-	#readPage(0xffff0000)
-	
-	clearStatus()
-	writeProg(prgseqs)
-	time.sleep(0.5) #wait 500ms
-	getStatus()
-	
-	#eraseAll()
+		clearStatus()
+		flashPlan(plan, manifest,
+			manifestKey(board or device, version), timing)
 
-	readPage(0xffff0000)
-	
+		if not quiet:
+			readPage(0xffff0000)
 
-	# save time at this point for evaluating the duration at the end
-	starttime = time.time()
+		# save time at this point for evaluating the duration at the end
+		starttime = time.time()
+	finally:
+		if stats is not None:
+			stats.save()
 
 
 if __name__ == '__main__':